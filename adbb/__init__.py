@@ -15,10 +15,16 @@
 # You should have received a copy of the GNU General Public License
 # along with adbb.  If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
+import contextlib
 import multiprocessing
 import logging
 import logging.handlers
+import os
 import sys
+import threading
+
+import sqlalchemy
 
 import adbb.db
 from adbb.link import AniDBLink
@@ -31,9 +37,15 @@ anidb_client_name = "adbb"
 anidb_client_version = 2
 anidb_api_version = 3
 
+# Raise an error instead of lazy loading anime data from the database, which
+# usually means one query per object. For debugging/tests only.
+debug_raise_on_lazy = False
+
 log = None
 _anidb = None
 _sessionmaker = None
+_batch_session = None
+_batch_lock = threading.RLock()
 
 
 def init(
@@ -69,13 +81,114 @@ def init(
 
 
 def get_session():
+    if _batch_session:
+        # callbacks run in the AniDBLink thread, so make sure only one
+        # thread at a time uses the shared session.
+        _batch_lock.acquire()
+        # the batch might have ended while we waited for the lock
+        if _batch_session:
+            # Each checkout gets its own savepoint, so a failing object
+            # only rolls back its own changes and not the whole batch.
+            _batch_session.begin_nested()
+            return _batch_session
+        _batch_lock.release()
     return _sessionmaker()
 
 
 def close_session(session):
-    session.close()
+    if session is _batch_session:
+        try:
+            # changes that were not committed are discarded, just like when
+            # closing a normal session
+            session.get_nested_transaction().rollback()
+        finally:
+            _batch_lock.release()
+    else:
+        session.close()
+
+
+@contextlib.contextmanager
+def db_session():
+    """Check out a session and make sure it's closed (or returned to the
+    batch) even if something fails while using it."""
+    session = get_session()
+    try:
+        yield session
+    finally:
+        close_session(session)
+
+
+def commit_session(session):
+    if session is _batch_session:
+        # release the savepoint, changes are committed when the batch ends
+        session.get_nested_transaction().commit()
+        session.begin_nested()
+    else:
+        session.commit()
+
+
+def rollback_session(session):
+    if session is _batch_session:
+        session.get_nested_transaction().rollback()
+        session.begin_nested()
+    else:
+        session.rollback()
+
+
+@contextlib.contextmanager
+def batch():
+    """Commit all database changes made within the with-block at once
+    when it ends, instead of once for every updated object. Useful when
+    updating many objects in a row."""
+    global _batch_session
+    if _batch_session:
+        # already in a batch, the outermost one commits
+        yield
+        return
+    _batch_session = _sessionmaker()
+    try:
+        yield
+    finally:
+        # Commit even if the block raised; without a batch these changes
+        # would already have been saved.
+        with _batch_lock:
+            session = _batch_session
+            _batch_session = None
+            try:
+                session.commit()
+            except sqlalchemy.exc.DBAPIError as e:
+                log.warning("Failed to commit batch: {}".format(e))
+                session.rollback()
+            finally:
+                session.close()
+
+
+def scan_directory(paths, force_single_episode_series=False):
+    """Create File objects for all paths, for example all files found when
+    scanning a directory. The files are created in parallel, and so is the
+    guess of anime and episode from the path that is needed for files that
+    AniDB doesn't know."""
+    def create_file(path):
+        f = File(
+            path=path,
+            force_single_episode_series=force_single_episode_series)
+        if not (f.db_data and (f.db_data.fid or f.db_data.aid)):
+            try:
+                f._guess_anime_ep()
+            except Exception as e:
+                # the guess is only needed later, if at all; it will be
+                # retried then
+                log.warning("Failed to guess anime and episode for {}: {}".format(
+                    path, e))
+        return f
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=os.cpu_count()) as executor:
+        return list(executor.map(create_file, paths))
 
 
 def close():
     global _anidb
     _anidb.stop()
+    # don't wait for files that are queued for hashing
+    adbb.fileinfo.cancel_background_hashing()
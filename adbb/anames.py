@@ -17,10 +17,12 @@
 
 import datetime
 import difflib
+import functools
 import gzip
 import os
 import sys
 import tempfile
+import threading
 import time
 import xml.etree.ElementTree as etree
 
@@ -44,11 +46,17 @@ _update_interval = datetime.timedelta(hours=36)
 
 xml = None
 languages = None
+# only load the titles and language files once when searched from several
+# threads
+_xml_lock = threading.RLock()
 
 
 def update_animetitles():
     global xml
 
+    # any cached search result might be based on an older titles file
+    _get_titles.cache_clear()
+
     file_name = _animetitles_url.split('/')[-1]
     if os.name == 'posix':
         animetitles_file = os.path.join('/var/tmp', file_name)
@@ -133,17 +141,22 @@ def _read_xml_into_etree(filePath):
 
 def _read_language_file():
     global languages
-    languages = {}
+    # fill a new dict and publish it when done, other threads must never
+    # see a partially read language file
+    codes = {}
     with open(iso_639_file, "r") as f:
         for line in f:
             three, tree2, two, eng, fre = line.strip().split('|')
             if two:
-                languages[two] = three
+                codes[two] = three
+    languages = codes
 
 
 def get_lang_code(short):
     if not languages:
-        _read_language_file()
+        with _xml_lock:
+            if not languages:
+                _read_language_file()
 
     if short in languages:
         return languages[short]
@@ -151,10 +164,20 @@ def get_lang_code(short):
     
 
 def get_titles(name=None, aid=None, max_results=10, score_for_match=0.6):
+    # the cached result is shared, so titles are stored as tuples and the
+    # result list is copied
+    return list(_get_titles(name, aid, max_results, score_for_match))
+
+
+# Fuzzy matching against all titles is slow, and the same title is usually
+# searched for several times when scanning files (once per Anime object).
+@functools.lru_cache(maxsize=4096)
+def _get_titles(name, aid, max_results, score_for_match):
     res = []
 
-    if xml is None:
-        update_animetitles()
+    with _xml_lock:
+        if xml is None:
+            update_animetitles()
     if xml is None:
         raise AniDBFileError('Could not get valid title cache file.')
 
@@ -177,16 +200,16 @@ def get_titles(name=None, aid=None, max_results=10, score_for_match=0.6):
                     best_title_match=title.text
 
         if score > score_for_match or exact_match:
-            titles = [
+            titles = tuple(
                     adbb.animeobjs.AnimeTitle(
                         x.get('type'),
                         get_lang_code(x.get('{http://www.w3.org/XML/1998/namespace}lang')),
-                        x.text) for x in anime.findall('title')]
+                        x.text) for x in anime.findall('title'))
             res.append((int(anime.get('aid')), titles, score, best_title_match))
 
     res.sort(key=lambda x: x[2], reverse=True)
     
     # response is a list of tuples in the form:
-    #(<aid>, <list of titles>, <score of best title>, <best title>)
-    return res[:max_results]
+    #(<aid>, <tuple of titles>, <score of best title>, <best title>)
+    return tuple(res[:max_results])
 
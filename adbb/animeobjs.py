@@ -16,12 +16,16 @@
 # along with adbb.  If not, see <http://www.gnu.org/licenses/>.
 
 import datetime
+import functools
 import os
 import random
 import re
 import threading
+import time
 
 import sqlalchemy
+from sqlalchemy import bindparam, select
+from sqlalchemy.orm import joinedload, raiseload, selectinload
 
 import adbb
 import adbb.anames
@@ -31,15 +35,61 @@ from adbb.db import *
 from adbb.commands import *
 from adbb.errors import *
 
+# seconds between checks if cached data should be refreshed
+_freshness_check_interval = 60
+
+# Statements used to find cached objects in the database. They are built once
+# so SQLAlchemy can reuse the compiled statements for every lookup.
+_anime_select = select(AnimeTable).options(
+    selectinload(AnimeTable.relations))
+_anime_by_aid = _anime_select.where(AnimeTable.aid == bindparam('aid'))
+_anime_by_aids = _anime_select.where(AnimeTable.aid.in_(bindparam('aids', expanding=True)))
+_episode_by_eid = select(EpisodeTable).where(
+    EpisodeTable.eid == bindparam('eid'))
+_episode_by_epno = select(EpisodeTable).where(
+    EpisodeTable.aid == bindparam('aid'),
+    EpisodeTable.epno == bindparam('epno'))
+_file_select = select(FileTable).options(
+    joinedload(FileTable.anime),
+    joinedload(FileTable.episode))
+_file_by_fid = _file_select.where(FileTable.fid == bindparam('fid'))
+_file_by_lid = _file_select.where(FileTable.lid == bindparam('lid'))
+_file_by_path = _file_select.where(FileTable.path == bindparam('path'))
+_generic_file_by_eid = _file_select.where(
+    FileTable.aid == bindparam('aid'),
+    FileTable.eid == bindparam('eid'),
+    FileTable.path.is_(None))
+
+
+def _anime_statement(statement):
+    """Make all lazy loads raise an error when adbb.debug_raise_on_lazy is
+    set, to find code that queries the database once per object."""
+    if adbb.debug_raise_on_lazy:
+        return statement.options(raiseload('*'))
+    return statement
+
 
 class AniDBObj(object):
     def __init__(self):
         self._anidb_link = adbb._anidb
         self._illegal_object = False
-        self._updated = threading.Event()
-        self._updating = threading.Lock()
+        # _in_flight is True while an update is running, waiters are woken
+        # through _cv when it's done.
+        self._cv = threading.Condition()
+        self._in_flight = False
+        self._last_freshness_check = float('-inf')
         self.db_data = None
 
+    @property
+    def db_data(self):
+        return self._db_data
+
+    @db_data.setter
+    def db_data(self, value):
+        self._db_data = value
+        # values read through __getattr__, see there
+        self._attr_cache = {}
+
     def _fetch_anidb_data(self, block):
         adbb.log.debug("Seding anidb request for {}".format(self))
         thread = threading.Thread(
@@ -51,14 +101,35 @@ class AniDBObj(object):
         if self._illegal_object:
             raise IllegalAnimeObject("{} is not a valid AniDB object".format(self))
 
-    def update(self, block=False):
-        locked = self._updating.acquire(False)
-        if not locked:
-            if block:
-                self._updating.acquire(True)
-                self._updating.release()
+    def _start_update(self, block):
+        """Mark this object as being updated. If an update is already
+        running, return False (after waiting for it to finish if block)."""
+        with self._cv:
+            if self._in_flight:
+                if block:
+                    while self._in_flight:
+                        self._cv.wait()
+                return False
+            self._in_flight = True
+        return True
+
+    def _wait_for_update(self):
+        """Block until any running update of this object is done."""
+        if not self._in_flight:
             return
-        self._fetch_anidb_data(block=block)
+        with self._cv:
+            while self._in_flight:
+                self._cv.wait()
+
+    def _update_done(self):
+        with self._cv:
+            self._in_flight = False
+            self._attr_cache = {}
+            self._cv.notify_all()
+
+    def update(self, block=False):
+        if self._start_update(block):
+            self._fetch_anidb_data(block=block)
 
     def _extra_refresh_probability(self):
         return 0
@@ -67,6 +138,12 @@ class AniDBObj(object):
         if not self.db_data:
             self.update(block=True)
         else:
+            # This is called for every attribute access, so don't bother
+            # checking the age again if we just did.
+            now = time.monotonic()
+            if now - self._last_freshness_check < _freshness_check_interval:
+                return
+            self._last_freshness_check = now
             age = datetime.datetime.now() - self.db_data.updated
             ref = datetime.timedelta()
             # never update twice the same day...
@@ -101,15 +178,25 @@ class AniDBObj(object):
     def _send_anidb_update_req(self):
         raise Exception("Not implemented")
 
-    def _close_db_session(self, session):
-        session.close()
+    def _db_session(self):
+        return adbb.db_session()
 
-    def _get_db_session(self):
-        return adbb.get_session()
+    def _loaded_db_attr(self, name):
+        """Return attribute name of db_data if it's already loaded, without
+        querying the database for it. Otherwise None."""
+        if not self.db_data or name in sqlalchemy.inspect(self.db_data).unloaded:
+            return None
+        return getattr(self.db_data, name)
+
+    def _update_db_data(self, **kwargs):
+        """Change attributes of db_data in place. Use this instead of setting
+        them directly, so values cached by __getattr__ are dropped."""
+        self.db_data.update(**kwargs)
+        self._attr_cache = {}
 
     def _db_commit(self, session):
         try:
-            session.commit()
+            adbb.commit_session(session)
             adbb.log.debug("Object saved to database: {}".format(self.db_data))
         except sqlalchemy.exc.DBAPIError as e:
             if self.db_data:
@@ -117,7 +204,7 @@ class AniDBObj(object):
                     self.db_data, e))
             else:
                 adbb.log.warning("Failed to update db: {}".format(e))
-            session.rollback()
+            adbb.rollback_session(session)
 
     def __getattr__(self, name):
         local_vars = vars(self)
@@ -127,10 +214,26 @@ class AniDBObj(object):
         if local_name in local_vars and local_vars[local_name]:
             return local_vars[local_name]
 
-        self._updating.acquire()
-        self._updating.release()
+        # Values read from db_data are cached until db_data is replaced or
+        # updated, as long as no update is running and we don't need to check
+        # if it should be refreshed. Saves the update checks for each
+        # attribute access.
+        cache = local_vars['_attr_cache']
+        if name in cache and not self._in_flight and \
+                time.monotonic() - self._last_freshness_check < _freshness_check_interval:
+            return cache[name]
+
+        self._wait_for_update()
         self.update_if_old()
-        return getattr(self.db_data, name, None)
+        # An update in another thread may replace db_data and the cache at
+        # any time; only cache the value if both are still the ones we read.
+        data = self._db_data
+        cache = self._attr_cache
+        value = getattr(data, name, None)
+        if data is not None and self._db_data is data and \
+                self._attr_cache is cache:
+            cache[name] = value
+        return value
 
 
 class Anime(AniDBObj):
@@ -140,17 +243,33 @@ class Anime(AniDBObj):
         self._titles = None
         self._title = None
 
-        if isinstance(init, int):
-            self._aid, self._titles, score, best_title = adbb.anames.get_titles(
-                aid=init)[0]
+        # Titles are only searched for when creating the anime by name,
+        # otherwise they are fetched when (if) they are needed.
+        if isinstance(init, AnimeTable):
+            # already loaded from the database, no need to query it again.
+            self._aid = init.aid
+            self.db_data = init
+        elif isinstance(init, int):
+            self._aid = init
         elif isinstance(init, str):
             self._aid, self._titles, score, best_title = adbb.anames.get_titles(
                 name=init)[0]
 
-        self._title = [x.title for x in self.titles
-                       if x.lang is None and x.titletype == 'main'][0]
-        self.db_data = None
-        self._get_db_data()
+        if not self.db_data:
+            self._get_db_data()
+
+    @property
+    def titles(self):
+        if not self._titles:
+            self._titles = adbb.anames.get_titles(aid=self.aid)[0][1]
+        return self._titles
+
+    @property
+    def title(self):
+        if not self._title:
+            self._title = next((x.title for x in self.titles
+                                if x.lang is None and x.titletype == 'main'), None)
+        return self._title
 
     def _extra_refresh_probability(self):
         now = datetime.datetime.now()
@@ -167,96 +286,103 @@ class Anime(AniDBObj):
             probability -= 20
         return max(probability, 0)
 
-    def _get_db_data(self, close=True):
-        sess = self._get_db_session()
-        res = sess.query(AnimeTable).filter_by(aid=self.aid).all()
-        if len(res) > 0:
-            self.db_data = res[0]
-        if close:
-            self._close_db_session(sess)
+    def _get_db_data(self):
+        aid = self.aid
+        with self._db_session() as sess:
+            res = sess.execute(
+                _anime_statement(_anime_by_aid),
+                {'aid': aid}).scalars().first()
+            if res:
+                self.db_data = res
 
     def _db_data_callback(self, res):
         ainfo = res.datalines[0]
-        relations = []
         new = None
         if res.rescode == "330":
             self._illegal_object = True
-            self.log.warning('{} is not a valid Anime object'.format(self))
-            self._updated.set()
+            adbb.log.warning('{} is not a valid Anime object'.format(self))
+            self._update_done()
             return
 
-        if all([x in ainfo and ainfo[x] for x in ['related_aid_list', 'related_aid_type']]):
-            relations = zip(
-                ainfo['related_aid_list'].split("'"),
-                ainfo['related_aid_type'].split("'"))
-        if 'related_aid_list' in ainfo:
-            del ainfo['related_aid_list']
-        if 'related_aid_type' in ainfo:
-            del ainfo['related_aid_type']
-        relations = [
-            AnimeRelationTable(
-                related_aid=int(x),
-                relation_type=adbb.mapper.anime_relation_map[y])
-            for x, y in relations]
+        related_aids = ainfo.pop('related_aid_list', None)
+        related_types = ainfo.pop('related_aid_type', None)
+        relations = []
+        if related_aids and related_types:
+            relation_map = adbb.mapper.anime_relation_map
+            relations = [
+                AnimeRelationTable(
+                    related_aid=int(x),
+                    relation_type=relation_map[y])
+                for x, y in zip(related_aids.split("'"), related_types.split("'"))]
 
         # convert datatypes
+        converters = adbb.mapper.anime_map_a_converters
         for attr, data in ainfo.items():
-            if attr in adbb.mapper.anime_map_a_converters:
-                ainfo[attr] = adbb.mapper.anime_map_a_converters[attr](data)
+            convert = converters.get(attr)
+            if convert:
+                ainfo[attr] = convert(data)
 
-        sess = self._get_db_session()
-        if self.db_data:
-            self.db_data = sess.merge(self.db_data)
-            self.db_data.update(**ainfo)
-            self.db_data.updated = datetime.datetime.now()
-            new_relations = []
-            for r in relations:
-                found = False
+        with self._db_session() as sess:
+            if self.db_data:
+                self.db_data = sess.merge(self.db_data)
+                self._update_db_data(**ainfo)
+                self._update_db_data(updated=datetime.datetime.now())
+                existing = {}
                 for sr in self.db_data.relations:
-                    if r.related_aid == sr.related_aid:
-                        found = True
+                    existing.setdefault(sr.related_aid, sr)
+                new_relations = []
+                for r in relations:
+                    sr = existing.pop(r.related_aid, None)
+                    if sr:
                         sr.relation_type = r.relation_type
-                        sr.anime_pk = self.db_data.pk
-                        new_relations.append(sr)
-                if not found:
-                    r.anime_pk = self.db_data.pk
-                    new_relations.append(r)
-            for r in self.db_data.relations:
-                if r not in new_relations:
-                    sess.delete(r)
-            self.db_data.relations = new_relations
-        else:
-            new = AnimeTable(**ainfo)
-            new.updated = datetime.datetime.now()
-            new.relations = relations
-            # commit to sql database
-            sess.add(new)
-
-        if new:
-            self.db_data = new
-        self._db_commit(sess)
-        self._close_db_session(sess)
-        self._updated.set()
+                    else:
+                        sr = r
+                    sr.anime_pk = self.db_data.pk
+                    new_relations.append(sr)
+                keep = set(new_relations)
+                for r in self.db_data.relations:
+                    if r not in keep:
+                        sess.delete(r)
+                self._update_db_data(relations=new_relations)
+            else:
+                new = AnimeTable(**ainfo)
+                new.updated = datetime.datetime.now()
+                new.relations = relations
+                # commit to sql database
+                sess.add(new)
+
+            if new:
+                self.db_data = new
+            self._db_commit(sess)
+        self._update_done()
 
     def _send_anidb_update_req(self, prio=False):
-        self._updated.clear()
         req = AnimeCommand(
             aid=str(self.aid),
-            amask=adbb.mapper.getAnimeBitsA(adbb.mapper.anime_map_a))
+            amask=adbb.mapper.anime_bits_a)
         self._anidb_link.request(req, self._db_data_callback, prio=prio)
-        self._updated.wait()
-        self._updating.release()
+        self._wait_for_update()
 
     @property
     def relations(self):
-        try:
-            relations = [(x.relation_type, Anime(x.related_aid)) for x in self.db_data.relations]
-        except sqlalchemy.orm.exc.DetachedInstanceError:
-            self._get_db_data(close=False)
-            sess = self._get_db_session()
-            relations = [(x.relation_type, Anime(x.related_aid)) for x in self.db_data.relations]
-            self._close_db_session(sess)
-        return relations
+        related = self._loaded_db_attr('relations')
+        if related is None:
+            # not loaded together with the anime (it might come from a
+            # File), reload it rather than lazy loading relations
+            self._get_db_data()
+            related = self.db_data.relations
+
+        # fetch all related anime we already know about in a single query
+        # instead of letting each Anime object query the database by itself.
+        aids = [x.related_aid for x in related]
+        rows = {}
+        if aids:
+            with self._db_session() as sess:
+                rows = {x.aid: x for x in sess.execute(
+                    _anime_statement(_anime_by_aids),
+                    {'aids': aids}).scalars()}
+        return [(x.relation_type, Anime(rows.get(x.related_aid, x.related_aid)))
+                for x in related]
 
     def __eq__(self, other):
         if not isinstance(other, Anime):
@@ -269,9 +395,10 @@ class Anime(AniDBObj):
         return other.aid == self.aid
 
     def __repr__(self):
-        return "Anime(title='{}', aid={})".format(
-            self.title,
-            self.aid)
+        # don't search for titles just to log this object
+        if not self._titles:
+            return "Anime(aid={})".format(self.aid)
+        return "Anime(title='{}', aid={})".format(self.title, self.aid)
 
 
 class AnimeTitle:
@@ -314,6 +441,10 @@ class Episode(AniDBObj):
             raise IllegalAnimeObject(
                     "Episode must be created with either anime and epno, "\
                     "or eid.")
+        if isinstance(eid, EpisodeTable):
+            # already loaded from the database, no need to query it again
+            self.db_data = eid
+            eid = eid.eid
         if eid:
             self._eid = eid
         if anime:
@@ -327,8 +458,11 @@ class Episode(AniDBObj):
             except ValueError:
                 pass
             self._episode_number = epno
-        self.db_data = None
-        self._get_db_data()
+        if self.db_data:
+            if self.db_data.epno:
+                self._episode_number = self.db_data.epno
+        else:
+            self._get_db_data()
 
     def _extra_refresh_probability(self):
         probability = 0
@@ -339,29 +473,31 @@ class Episode(AniDBObj):
         return max(probability, 0)
 
     def _get_db_data(self):
-        sess = self._get_db_session()
+        # resolve the episode number before checking out a session, see
+        # File._get_db_data()
         if self._eid:
-            res = sess.query(EpisodeTable).filter_by(eid=self._eid).all()
+            statement, params = _episode_by_eid, {'eid': self._eid}
         else:
-            res = sess.query(EpisodeTable).filter_by(
-                aid=self._anime.aid,
-                epno=self.episode_number).all()
-        if len(res) > 0:
-            self.db_data = res[0]
-            adbb.log.debug("Found db_data for episode: {}".format(self.db_data))
-            if self.db_data.epno:
-                self._episode_number = self.db_data.epno
-        self._close_db_session(sess)
+            statement, params = _episode_by_epno, {
+                'aid': self._anime.aid,
+                'epno': self.episode_number}
+        with self._db_session() as sess:
+            res = sess.execute(statement, params).scalars().first()
+            if res:
+                self.db_data = res
+                adbb.log.debug("Found db_data for episode: {}".format(self.db_data))
+                if self.db_data.epno:
+                    self._episode_number = self.db_data.epno
 
     def _anidb_data_callback(self, res):
-        sess = self._get_db_session()
         if res.rescode == "340":
             adbb.log.warning("No such episode in anidb: {}".format(self))
             self._illegal_object = True
-            self._updated.set()
+            self._update_done()
             return
         einfo = res.datalines[0]
         new = None
+        converters = adbb.mapper.episode_map_converters
         for attr, data in einfo.items():
             if attr == 'epno':
                 try:
@@ -371,33 +507,33 @@ class Episode(AniDBObj):
                 continue
             if attr in ('title_eng', 'title_romaji', 'title_kanji'):
                 continue
-            einfo[attr] = adbb.mapper.episode_map_converters[attr](data)
+            convert = converters.get(attr)
+            if convert:
+                einfo[attr] = convert(data)
 
-        if self.db_data:
-            self.db_data = sess.merge(self.db_data)
-            self.db_data.update(**einfo)
-            self.db_data.updated = datetime.datetime.now()
-        else:
-            new = EpisodeTable(**einfo)
-            new.updated = datetime.datetime.now()
-            sess.add(new)
+        with self._db_session() as sess:
+            if self.db_data:
+                self.db_data = sess.merge(self.db_data)
+                self._update_db_data(**einfo)
+                self._update_db_data(updated=datetime.datetime.now())
+            else:
+                new = EpisodeTable(**einfo)
+                new.updated = datetime.datetime.now()
+                sess.add(new)
 
-        if new:
-            self.db_data = new
+            if new:
+                self.db_data = new
 
-        self._db_commit(sess)
-        self._close_db_session(sess)
-        self._updated.set()
+            self._db_commit(sess)
+        self._update_done()
 
     def _send_anidb_update_req(self, prio=False):
-        self._updated.clear()
         if self._eid:
             req = EpisodeCommand(eid=self._eid)
         else:
             req = EpisodeCommand(aid=self._anime.aid, epno=self.episode_number)
         self._anidb_link.request(req, self._anidb_data_callback, prio=prio)
-        self._updated.wait()
-        self._updating.release()
+        self._wait_for_update()
 
     def __eq__(self, other):
         if not isinstance(other, Episode):
@@ -423,6 +559,9 @@ class File(AniDBObj):
     _path = None
     _size = None
     _ed2khash = None
+    _ed2k_future = None
+    _guessed_anime = None
+    _guessed_episodes = None
     _mtime = None
     _lid = None
 
@@ -430,7 +569,7 @@ class File(AniDBObj):
     def anime(self):
         if self._anime:
             return self._anime
-        self._anime = Anime(self.aid)
+        self._anime = Anime(self._loaded_db_attr('anime') or self.aid)
         return self._anime
 
     @property
@@ -443,7 +582,7 @@ class File(AniDBObj):
         if self._anime:
             kwargs['anime'] = self._anime
         if self.db_data and self.db_data.eid:
-            kwargs['eid'] = self.db_data.eid
+            kwargs['eid'] = self._loaded_db_attr('episode') or self.db_data.eid
         if ('epno' in kwargs and 'anime' in kwargs) \
                 or 'eid' in kwargs:
             adbb.log.debug("Creating episode with {}".format(kwargs))
@@ -467,26 +606,29 @@ class File(AniDBObj):
         else:
             return [self.episode.episode_number]
 
+    def _ensure_stats(self):
+        # size and mtime comes from the same stat call, so set both at once
+        if self._size is None or self._mtime is None:
+            self._mtime, self._size = adbb.fileinfo.get_file_stats(
+                self.path,
+                self.nfs_obj)
+
     @property
     def size(self):
-        if self._size:
+        if self._size is not None:
             return self._size
         if self.path:
-            self._mtime, self._size = adbb.fileinfo.get_file_stats(
-                self.path,
-                self.nfs_obj)
+            self._ensure_stats()
         elif self.db_data and self.db_data.size:
             self._size = self.db_data.size
         return self._size
 
     @property
     def mtime(self):
-        if self._mtime:
+        if self._mtime is not None:
             return self._mtime
         if self.path:
-            self._mtime, self._size = adbb.fileinfo.get_file_stats(
-                self.path,
-                self.nfs_obj)
+            self._ensure_stats()
         elif self.db_data and self.db_data.mtime:
             self._mtime = self.db_data.mtime
         return self._mtime
@@ -496,29 +638,26 @@ class File(AniDBObj):
         if self._ed2khash:
             return self._ed2khash
         elif self._path:
-            if self.db_data and \
-                    self.db_data.mtime and \
-                    self.db_data.size and \
-                    self.db_data.ed2khash:
-                mtime, size = adbb.fileinfo.get_file_stats(
-                    self.path,
-                    self.nfs_obj)
-                if mtime == self.db_data.mtime and size == self.db_data.size:
-                    self._ed2khash = self.db_data.ed2khash
-
+            self._ed2khash = self._db_ed2khash()
             if self._ed2khash:
                 return self._ed2khash
 
-            self._ed2khash = adbb.fileinfo.get_file_hash(
-                self._path,
-                self.nfs_obj)
+            # Use the background hash if it's already started, otherwise
+            # take the file out of the queue and hash it right away instead
+            # of waiting for all files queued before it. A future cancelled
+            # by adbb.close() also ends up here.
+            if self._ed2k_future and not self._ed2k_future.cancel():
+                self._ed2khash = self._ed2k_future.result()
+            if not self._ed2khash:
+                self._ed2khash = adbb.fileinfo.get_file_hash(
+                    self._path,
+                    self.nfs_obj)
             adbb.log.debug("Calculated ed2khash: {}".format(self._ed2khash))
             return self._ed2khash
 
         adbb.log.debug("Trying to fetch ed2khash from anidb")
         # wait for any update process to finish
-        self._updating.acquire()
-        self._updating.release()
+        self._wait_for_update()
         if not self.db_data and not self.db_data.ed2khash:
             self.update_if_old(block=True)
         if self.db_data:
@@ -546,9 +685,7 @@ class File(AniDBObj):
         self.nfs_obj = nfs_obj
         if path:
             self._path = path
-            self._mtime, self._size = adbb.fileinfo.get_file_stats(
-                self._path,
-                self.nfs_obj)
+            self._ensure_stats()
             adbb.log.debug("Created File {} - size: {}, mtime: {}".format(self._path, self._size, self._mtime))
         if fid:
             self._fid = int(fid)
@@ -567,6 +704,29 @@ class File(AniDBObj):
                 self._multiep = [episode]
         self._get_db_data()
 
+        # Start hashing the file right away, so it's done (or at least
+        # started) by the time we need it for the AniDB requests. Not done
+        # for a shared nfs context, as it would be used from another thread,
+        # or when the fid is already known, as AniDB is then queried by fid.
+        known_fid = self._fid or (self.db_data and self.db_data.fid)
+        if self._path and not self.nfs_obj and not known_fid \
+                and not self._db_ed2khash():
+            self._ed2k_future = adbb.fileinfo.hash_file_in_background(
+                self._path)
+
+    def _db_ed2khash(self):
+        """Return the ed2khash from the database if the file hasn't changed
+        since it was calculated, otherwise None."""
+        if self.db_data and \
+                self.db_data.mtime and \
+                self.db_data.size and \
+                self.db_data.ed2khash:
+            self._ensure_stats()
+            if self._mtime == self.db_data.mtime and \
+                    self._size == self.db_data.size:
+                return self.db_data.ed2khash
+        return None
+
     def _extra_refresh_probability(self):
         probability = 0
         # For files, add 1% probability if it is a generic file that is in
@@ -576,27 +736,33 @@ class File(AniDBObj):
         return max(probability, 0)
 
     def _get_db_data(self):
-        sess = self._get_db_session()
-        res = None
+        # resolve everything that might need AniDB (like the eid) before
+        # checking out a session; in a batch the session is locked while we
+        # use it, and the AniDB callbacks need it as well.
+        by_path = False
         if self._fid:
-            res = sess.query(FileTable).filter_by(fid=self._fid).all()
+            statement, params = _file_by_fid, {'fid': self._fid}
         elif self._lid:
-            res = sess.query(FileTable).filter_by(lid=self._lid).all()
+            statement, params = _file_by_lid, {'lid': self._lid}
         elif self._path:
-            res = sess.query(FileTable).filter_by(path=self._path).all()
-            if res and res[0].size != self._size:
-                sess.delete(res[0])
+            statement, params = _file_by_path, {'path': self._path}
+            by_path = True
+        else:
+            eid = self._episode.eid
+            if not eid:
+                return
+            statement, params = _generic_file_by_eid, {
+                'aid': self._anime.aid,
+                'eid': eid}
+        with self._db_session() as sess:
+            res = sess.execute(statement, params).scalars().first()
+            if by_path and res and res.size != self._size:
+                sess.delete(res)
                 self._db_commit(sess)
-                res = []
-        elif self._episode.eid:
-            res = sess.query(FileTable).filter_by(
-                aid=self._anime.aid,
-                eid=self._episode.eid,
-                path=None).all()
-        if res and len(res) > 0:
-            self.db_data = res[0]
-            adbb.log.debug("Found db_data for file: {}".format(self.db_data))
-        self._close_db_session(sess)
+                res = None
+            if res:
+                self.db_data = res
+                adbb.log.debug("Found db_data for file: {}".format(self.db_data))
 
     def _anidb_file_data_callback(self, res):
         new = None
@@ -619,30 +785,21 @@ class File(AniDBObj):
                 state = int(finfo['state'])
                 del finfo['state']
 
+            converters = adbb.mapper.file_map_f_converters
             for attr, data in finfo.items():
-                if attr in adbb.mapper.file_map_f_converters:
-                    finfo[attr] = adbb.mapper.file_map_f_converters[attr](data)
-                else:
-                    finfo[attr] = data
-
-            if state & 0x1:
-                finfo['crc_ok'] = True
-            elif state & 0x2:
-                finfo['crc_ok'] = False
-            if state & 0x4:
-                finfo['file_version'] = 2
-            elif state & 0x8:
-                finfo['file_version'] = 3
-            elif state & 0x10:
-                finfo['file_version'] = 4
-            elif state & 0x20:
-                finfo['file_version'] = 5
-            else:
-                finfo['file_version'] = 1
-            if state & 0x40:
-                finfo['censored'] = False
-            elif state & 0x80:
-                finfo['censored'] = True
+                convert = converters.get(attr)
+                if convert:
+                    finfo[attr] = convert(data)
+
+            # 0x1: crc ok, 0x2: crc error
+            if state & 0x3:
+                finfo['crc_ok'] = bool(state & 0x1)
+            finfo['file_version'] = next(
+                (v for bit, v in adbb.mapper.file_state_version_map.items()
+                 if state & bit), 1)
+            # 0x40: uncensored, 0x80: censored
+            if state & 0xc0:
+                finfo['censored'] = not state & 0x40
 
             finfo['is_generic'] = False
 
@@ -674,20 +831,19 @@ class File(AniDBObj):
             finfo['lid'] = None
             self.remove_from_mylist()
 
-        sess = self._get_db_session()
-        if self.db_data:
-            self.db_data = sess.merge(self.db_data)
-            self.db_data.update(**finfo)
-            self.db_data.updated = datetime.datetime.now()
-        else:
-            new = FileTable(**finfo)
-            new.updated = datetime.datetime.now()
-            sess.add(new)
-
-        if new:
-            self.db_data = new
-        self._db_commit(sess)
-        self._close_db_session(sess)
+        with self._db_session() as sess:
+            if self.db_data:
+                self.db_data = sess.merge(self.db_data)
+                self._update_db_data(**finfo)
+                self._update_db_data(updated=datetime.datetime.now())
+            else:
+                new = FileTable(**finfo)
+                new.updated = datetime.datetime.now()
+                sess.add(new)
+
+            if new:
+                self.db_data = new
+            self._db_commit(sess)
         self._file_updated.set()
 
         if update_mylist:
@@ -697,24 +853,31 @@ class File(AniDBObj):
                     source = self.db_data.mylist_source,
                     other = self.db_data.mylist_other)
 
-    def _anidb_mylist_data_callback(self, res):
+    def _anidb_mylist_data_callback(self, res, anime=None, episode=None):
+        """anime and episode are what the mylist entry was requested for,
+        if that was done by aid and epno."""
         new = None
+        anime = anime or self._anime
+        episode = episode or self._episode
         if res.rescode == '312':
             raise AniDBFileError("adbb currently does not support multiple mylist entries for a single episode")
         elif res.rescode == '321':
             finfo = {}
             if not self.db_data:
                 finfo['is_generic'] = True
-            if self._anime:
-                finfo['aid'] = self._anime.aid
-            if self._episode:
-                finfo['eid'] = self._episode.eid
+            if anime:
+                finfo['aid'] = anime.aid
+            if episode:
+                finfo['eid'] = episode.eid
         else:
             finfo = res.datalines[0]
             if 'date' in finfo:
                 del finfo['date']
+            converters = adbb.mapper.mylist_map_converters
             for attr, data in finfo.items():
-                finfo[attr] = adbb.mapper.mylist_map_converters[attr](data)
+                convert = converters.get(attr)
+                if convert:
+                    finfo[attr] = convert(data)
             # best guess, but this may not always be the case (does no group
             # have an ID?)
             if finfo['gid']:
@@ -731,28 +894,27 @@ class File(AniDBObj):
             finfo['ed2khash'] = self._ed2khash
             finfo['mtime'] = self._mtime
 
-        sess = self._get_db_session()
-        if self.db_data:
-            # This is not our file if we are a generic, but got a gid or we
-            # have a fid/lid which is not the same as the returned fid/lid
-            if (self.path and self.db_data.is_generic and 'gid' in finfo and finfo['gid']) \
-                    or (self.db_data.fid and 'fid' in finfo and self.db_data.fid != finfo['fid']) \
-                    or (self.db_data.lid and 'lid' in finfo and self.db_data.lid != finfo['lid']):
-                finfo = {}
-            adbb.log.debug("New mylist info: {}".format(finfo))
-            self.db_data = sess.merge(self.db_data)
-            self.db_data.update(**finfo)
-            self.db_data.updated = datetime.datetime.now()
-        else:
-            new = FileTable(**finfo)
-            new.updated = datetime.datetime.now()
-            sess.add(new)
-            adbb.log.debug("Adding mylist info: {}".format(finfo))
-
-        if new:
-            self.db_data = new
-        self._db_commit(sess)
-        self._close_db_session(sess)
+        with self._db_session() as sess:
+            if self.db_data:
+                # This is not our file if we are a generic, but got a gid or we
+                # have a fid/lid which is not the same as the returned fid/lid
+                if (self._path and self.db_data.is_generic and 'gid' in finfo and finfo['gid']) \
+                        or (self.db_data.fid and 'fid' in finfo and self.db_data.fid != finfo['fid']) \
+                        or (self.db_data.lid and 'lid' in finfo and self.db_data.lid != finfo['lid']):
+                    finfo = {}
+                adbb.log.debug("New mylist info: {}".format(finfo))
+                self.db_data = sess.merge(self.db_data)
+                self._update_db_data(**finfo)
+                self._update_db_data(updated=datetime.datetime.now())
+            else:
+                new = FileTable(**finfo)
+                new.updated = datetime.datetime.now()
+                sess.add(new)
+                adbb.log.debug("Adding mylist info: {}".format(finfo))
+
+            if new:
+                self.db_data = new
+            self._db_commit(sess)
         self._mylist_updated.set()
 
     def _send_anidb_update_req(self, prio=False, req_mylist=False, req_file=True):
@@ -766,8 +928,8 @@ class File(AniDBObj):
                 adbb.log.debug("sending file request with fid")
                 req = FileCommand(
                     fid=self._fid,
-                    fmask=adbb.mapper.getFileBitsF(adbb.mapper.file_map_f),
-                    amask=adbb.mapper.getFileBitsA(['epno'])
+                    fmask=adbb.mapper.file_bits_f,
+                    amask=adbb.mapper.file_bits_a_epno
                 )
                 self._anidb_link.request(req, self._anidb_file_data_callback,
                                          prio=prio)
@@ -778,14 +940,15 @@ class File(AniDBObj):
                 req = FileCommand(
                     size=self._size,
                     ed2k=self.ed2khash,
-                    fmask=adbb.mapper.getFileBitsF(adbb.mapper.file_map_f),
-                    amask=adbb.mapper.getFileBitsA(['epno']))
+                    fmask=adbb.mapper.file_bits_f,
+                    amask=adbb.mapper.file_bits_a_epno)
                 self._anidb_link.request(req, self._anidb_file_data_callback,
                                          prio=prio)
                 self._file_updated.wait()
         # We want to send a mylist request only if explicitly asked for, or if
         # we didn't get a fid from the File request
         if req_mylist or not self._fid:
+            callback = self._anidb_mylist_data_callback
             if self._fid:
                 adbb.log.debug("fetching mylist with fid")
                 req = MyListCommand(fid=self._fid)
@@ -793,32 +956,40 @@ class File(AniDBObj):
                 adbb.log.debug("fetching mylist with lid")
                 req = MyListCommand(lid=self._lid)
             else:
+                anime = self._anime
+                episode = self._episode
                 if self._path:
                     if self.db_data and self.db_data.aid:
-                        self._anime = Anime(self.db_data.aid)
+                        anime = self._anime = Anime(
+                            self._loaded_db_attr('anime') or self.db_data.aid)
                     if self.db_data and self.db_data.eid:
-                        self._episode = Episode(eid=self.db_data.eid)
-                    if not (self._anime and self._episode):
-                        if self._anime:
-                            aid = self._anime.aid
-                        else:
-                            aid = None
-                        anime, episodes = self._guess_anime_ep_from_file(aid=aid)
-                        if anime and episodes:
-                            self._multiep = [e.episode_number for e in episodes]
-                            self._anime = anime
-                            self._episode = episodes[0]
+                        episode = self._episode = Episode(
+                            eid=self._loaded_db_attr('episode') or self.db_data.eid)
+                    if not (anime and episode):
+                        # AniDB doesn't know this file, so look for a mylist
+                        # entry for the episode we guess it contains
+                        guessed_anime, guessed_episodes = self._guess_anime_ep(
+                            aid=anime.aid if anime else None)
+                        if guessed_anime and guessed_episodes:
+                            self._multiep = [e.episode_number for e in guessed_episodes]
+                            anime = guessed_anime
+                            episode = guessed_episodes[0]
                             if self.db_data and not self.db_data.aid:
-                                self.db_data.aid = anime.aid
+                                self._update_db_data(aid=anime.aid)
+                if not episode:
+                    episode = self.episode
                 adbb.log.debug("fetching mylist with aid and epno")
                 req = MyListCommand(
-                    aid=self._anime.aid,
-                    epno=self.episode.episode_number)
+                    aid=anime.aid,
+                    epno=episode.episode_number)
+                callback = functools.partial(
+                    self._anidb_mylist_data_callback,
+                    anime=anime,
+                    episode=episode)
             adbb.log.debug("sending mylist request")
-            self._anidb_link.request(req, self._anidb_mylist_data_callback,
-                                     prio=prio)
+            self._anidb_link.request(req, callback, prio=prio)
             self._mylist_updated.wait()
-        self._updating.release()
+        self._update_done()
 
     def __repr__(self):
         return "File(path='{}', fid={}, anime={}, episode={})". \
@@ -862,21 +1033,20 @@ class File(AniDBObj):
                 ed2k=self.ed2khash)
             self._anidb_link.request(req, _mylistdel_callback, prio=True)
         self._lid = None
-        sess = self._get_db_session()
-        finfo = {
-            'mylist_state': None,
-            'mylist_filestate': None,
-            'mylist_viewed': None,
-            'mylist_viewdate': None,
-            'mylist_storage': None,
-            'mylist_source': None,
-            'mylist_other': None,
-            'lid': None,
-        }
-        self.db_data = sess.merge(self.db_data)
-        self.db_data.update(**finfo)
-        self._db_commit(sess)
-        self._close_db_session(sess)
+        with self._db_session() as sess:
+            finfo = {
+                'mylist_state': None,
+                'mylist_filestate': None,
+                'mylist_viewed': None,
+                'mylist_viewdate': None,
+                'mylist_storage': None,
+                'mylist_source': None,
+                'mylist_other': None,
+                'lid': None,
+            }
+            self.db_data = sess.merge(self.db_data)
+            self._update_db_data(**finfo)
+            self._db_commit(sess)
         wait.wait()
 
     def update_mylist(
@@ -904,11 +1074,10 @@ class File(AniDBObj):
                 elif 'entrycnt' in res.datalines[0]:
                     res = int(res.datalines[0]['entrycnt'])
                 if res > 1:
-                    sess = self._get_db_session()
-                    self.db_data = sess.merge(self.db_data)
-                    self.db_data.update(lid=res)
-                    self._db_commit(sess)
-                    self._close_db_session(sess)
+                    with self._db_session() as sess:
+                        self.db_data = sess.merge(self.db_data)
+                        self._update_db_data(lid=res)
+                        self._db_commit(sess)
             wait.set()
 
         try:
@@ -971,33 +1140,43 @@ class File(AniDBObj):
         self._anidb_link.request(req, _mylistadd_callback, prio=True)
         wait.wait()
         if edit:
-            sess = self._get_db_session()
-            self.db_data = sess.merge(self.db_data)
-            if state:
-                self.db_data.mylist_state = state
-            if watched:
-                self.db_data.mylist_viewed = True
-                if isinstance(watched, datetime.datetime):
-                    self.db_data.mylist_viewdate = watched
-                else:
-                    self.db_data.mylist_viewdate = datetime.datetime.now()
-            if source:
-                self.db_data.mylist_source = source
-            if other:
-                self.db_data.mylist_other = other
-            self._db_commit(sess)
-            self._close_db_session(sess)
+            with self._db_session() as sess:
+                self.db_data = sess.merge(self.db_data)
+                changes = {}
+                if state:
+                    changes['mylist_state'] = state
+                if watched:
+                    changes['mylist_viewed'] = True
+                    if isinstance(watched, datetime.datetime):
+                        changes['mylist_viewdate'] = watched
+                    else:
+                        changes['mylist_viewdate'] = datetime.datetime.now()
+                if source:
+                    changes['mylist_source'] = source
+                if other:
+                    changes['mylist_other'] = other
+                self._update_db_data(**changes)
+                self._db_commit(sess)
         else:
             # Oh lord, another slowdown? 
             # Sorry, since anidb doesn't return our lid and eid when adding we
             # have to do another request here...
-            locked = self._updating.acquire(False)
-            if not locked:
-                self._updating.acquire()
-                self._updating.release()
+            if not self._start_update(block=True):
                 return
             self._send_anidb_update_req(req_file=False, req_mylist=True)
 
+    def _guess_anime_ep(self, aid=None):
+        """Return (anime, episodes) guessed from the path, reusing an earlier
+        guess for the same anime. The guess is only used to look for a mylist
+        entry of a file that AniDB doesn't know; it's kept apart from the
+        anime and episode of the file, as AniDB may still identify it."""
+        if self._guessed_episodes is None or (aid and (
+                not self._guessed_anime or self._guessed_anime.aid != aid)):
+            anime, episodes = self._guess_anime_ep_from_file(aid=aid)
+            self._guessed_anime = anime
+            self._guessed_episodes = episodes or []
+        return (self._guessed_anime, self._guessed_episodes)
+
     def _guess_anime_ep_from_file(self, aid=None):
         if not self.path:
             return (None, None)
@@ -1026,13 +1205,13 @@ class File(AniDBObj):
             if not aid:
                 # strip away all kinds of paranthesis like
                 # [<group>], (<codec>) or {<crc>}.
-                stripped = re.sub(r'[{[(][^\]})]*?[})\]]', '', filename)
+                stripped = adbb.fileinfo.paren_re.sub('', filename)
                 # remove the file ending
-                stripped, tail = stripped.rsplit('.', 1)
+                stripped = stripped.rsplit('.', 1)[0]
                 # split out all words, this removes all dots, dashes and other
                 # unhealthy things :)
                 # Don't know if I should remove numbers here as well...
-                splitted = re.findall(r'[\w]+', stripped)
+                splitted = adbb.fileinfo.word_re.findall(stripped)
                 # Join back to a single string 
                 joined = " ".join(splitted)
                 # search anidb, but require lower score for match as this is
@@ -1053,18 +1232,20 @@ class File(AniDBObj):
 
         return (anime, episodes)
 
-    def _search_filename(self, filename, regex, anime):
+    def _search_filename(self, filename, res, anime):
         ret = []
-        res = regex.search(filename)
         if res:
-            eps = adbb.fileinfo.multiep_re.findall(res.group(3))
-            eps.insert(0, res.group(2))
+            eps = [res.group(2)]
+            # group 3 holds any additional episode numbers; it is always
+            # empty for some of the regexes
+            if res.group(3):
+                eps.extend(adbb.fileinfo.multiep_re.findall(res.group(3)))
             for m in eps:
                 try:
                     ep = int(m)
                 except ValueError:
                     adbb.log.warning("Got non-numeric episode number when searching '{}' with regex '{}'".format(
-                        filename, regex))
+                        filename, res.re))
                     continue
                 if res.group(1).lower() == 's':
                     ret.append("S{}".format(ep))
@@ -1087,17 +1268,8 @@ class File(AniDBObj):
         return ret
 
     def _guess_epno_from_filename(self, filename, anime):
-        count = 1
-        ret = None
-        for r in adbb.fileinfo.ep_nr_re:
-            # abort when we reach the fallback regex; represented by a None
-            # entry in the array
-            if not r:
-                break
-            count += 1
-            ret = self._search_filename(filename, r, anime)
-            if ret:
-                break
+        ret = self._search_filename(
+            filename, adbb.fileinfo.search_ep_nr(filename), anime)
         if not ret:
             if self.force_single_episode_series:
                 # We assume that this file belongs to an anime with just a
@@ -1111,10 +1283,8 @@ class File(AniDBObj):
 
             # multi episode series, but the regular regexp gave nothing, try
             # the fallbacks
-            for r in adbb.fileinfo.ep_nr_re[count:]:
-                ret = self._search_filename(filename, adbb.fileinfo.ep_nr_re[-1], anime)
-                if ret:
-                    break
+            ret = self._search_filename(
+                filename, adbb.fileinfo.ep_nr_re[-1].search(filename), anime)
             if not ret:
                 adbb.log.debug("file '{}': could not figure out episode number(s)".format(filename))
         return [Episode(anime=anime, epno=e) for e in ret]
@@ -25,11 +25,25 @@ Base = declarative_base()
 
 def init_db(url):
     engine = create_engine(url, pool_recycle=300)
+    if engine.dialect.name == 'sqlite':
+        _fix_sqlite_transactions(engine)
     Base.metadata.create_all(engine)
     session = sessionmaker(bind=engine, expire_on_commit=False)
     return session
 
 
+def _fix_sqlite_transactions(engine):
+    # pysqlite doesn't emit BEGIN itself, which breaks savepoints (used by
+    # adbb.batch()). Let sqlalchemy handle transactions instead.
+    @event.listens_for(engine, 'connect')
+    def _connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def _begin(conn):
+        conn.exec_driver_sql('BEGIN')
+
+
 class AnimeTable(Base):
     __tablename__ = 'anime'
 
@@ -218,6 +232,21 @@ class FileTable(Base):
 
     updated = Column(DateTime(timezone=True), nullable=True)
 
+    # aid and eid are not foreign keys (they are 0 when unknown), so these
+    # are only used to load the anime and episode together with the file.
+    # Nothing is cascaded, so merging a file never writes a (possibly
+    # stale) anime or episode back to the database.
+    anime = relationship(
+        AnimeTable,
+        primaryjoin='foreign(FileTable.aid) == AnimeTable.aid',
+        viewonly=True,
+        cascade='')
+    episode = relationship(
+        EpisodeTable,
+        primaryjoin='foreign(FileTable.eid) == EpisodeTable.eid',
+        viewonly=True,
+        cascade='')
+
     def update(self, **kwargs):
         for key, attr in kwargs.items():
             setattr(self, key, attr)
@@ -16,12 +16,15 @@
 # along with adbb.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import with_statement
+import concurrent.futures
 import datetime
 import difflib
 import functools
 import re
 import hashlib
 import os
+import queue
+import threading
 import xml.etree.cElementTree as etree
 
 try:
@@ -29,6 +32,11 @@ try:
 except ImportError:
     libnfs = None
 
+try:
+    from Crypto.Hash import MD4
+except ImportError:
+    MD4 = None
+
 import adbb.errors
 
 ep_nr_re = [
@@ -50,6 +58,36 @@ ep_nr_re = [
     re.compile(r'[/\._ \-]()([0-9]{1,4})([._ 0-9-]*)', re.I)  # if everything else fails, just match the first number(s)
 ]
 multiep_re = re.compile(r'[0-9]+')
+# all kinds of paranthesis like [<group>], (<codec>) or {<crc>}
+paren_re = re.compile(r'[{[(][^\]})]*?[})\]]')
+word_re = re.compile(r'[\w]+')
+
+# The regular (non-fallback) regexes in ep_nr_re fused into a single
+# alternation, so a filename only has to be scanned once in the common case.
+# Each regex is wrapped in a named group (p<index>) to tell which one matched.
+_ep_nr_regular_re = ep_nr_re[:ep_nr_re.index(None)]
+ep_nr_combined_re = re.compile(
+    '|'.join('(?P<p{}>{})'.format(i, r.pattern)
+             for i, r in enumerate(_ep_nr_regular_re)),
+    re.I)
+
+
+def search_ep_nr(filename):
+    """Return the match of the first regular regex in ep_nr_re that matches
+    filename, or None. Same result as trying each regex in order."""
+    res = ep_nr_combined_re.search(filename)
+    if not res:
+        return None
+    index = int(res.lastgroup[1:])
+    start = res.start()
+    # The alternation finds the leftmost match; a regex with higher priority
+    # can still match further into the filename. None of them matched at or
+    # before start, so they only need to be tried after that position.
+    for r in _ep_nr_regular_re[:index]:
+        higher = r.search(filename, start + 1)
+        if higher:
+            return higher
+    return _ep_nr_regular_re[index].match(filename, start)
 
 
 # http://www.radicand.org/blog/orz/2010/2/21/edonkey2000-hash-in-python/
@@ -61,33 +99,84 @@ def get_file_hash(path, nfs_obj=None):
         return _calculate_ed2khash(f)
 
 
-def _calculate_ed2khash(fileObj):
-    """ Returns the ed2k hash of a given file."""
-    md4 = hashlib.new('md4').copy
+def _get_md4():
+    """Return a function that creates an md4 hash object from some data.
+    OpenSSL 3 no longer provides md4 by default, so if hashlib can't do it we
+    use pycryptodome instead (both are implemented in C)."""
+    try:
+        hashlib.new('md4')
+        return functools.partial(hashlib.new, 'md4')
+    except ValueError:
+        pass
+    if not MD4:
+        raise adbb.errors.AniDBError(
+            "md4 not supported by hashlib and pycryptodome is not installed, "
+            "can't calculate ed2k hash")
+    return MD4.new
 
-    def gen(f):
-        while True:
-            x = f.read(9728000)
-            if x:
-                yield x
-            else:
-                return
-
-    def md4_hash(data):
-        m = md4()
-        m.update(data)
-        return m
 
-    a = gen(fileObj)
-    hashes = [md4_hash(data) for data in a]
+def _calculate_ed2khash(fileObj):
+    """ Returns the ed2k hash of a given file."""
+    md4 = _get_md4()
+    chunk_size = 9728000
+    hashes = []
+
+    # Read the next chunk in a separate thread while hashing the current one.
+    # Both file reads and hashing release the GIL for data this large.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as reader:
+        data = fileObj.read(chunk_size)
+        while data:
+            next_data = reader.submit(fileObj.read, chunk_size)
+            hashes.append(md4(data))
+            data = next_data.result()
+
+    if not hashes:
+        return md4(b'').hexdigest()
     if len(hashes) == 1:
         return hashes[0].hexdigest()
-    else:
-        # reduce goes from left to right, but will not run digest on the first
-        # entry, so we'll have to do that first.
-        hashes[0] = hashes[0].digest()
-        res = md4_hash(functools.reduce(lambda a, d: a + d.digest(), hashes)).hexdigest()
-        return res
+    return md4(b''.join(h.digest() for h in hashes)).hexdigest()
+
+
+# Files queued for hashing in the background, see hash_file_in_background()
+_hash_queue = queue.Queue()
+_hash_worker = None
+_hash_worker_lock = threading.Lock()
+
+
+def hash_file_in_background(path):
+    """Queue a (local) file for ed2k hashing and return a
+    concurrent.futures.Future for the hash. Files are hashed one at a time, as
+    hashing several files at once just makes the disk seek. The worker is a
+    daemon thread, so exiting python doesn't wait for queued files."""
+    global _hash_worker
+    with _hash_worker_lock:
+        if not _hash_worker:
+            _hash_worker = threading.Thread(target=_hash_files, daemon=True)
+            _hash_worker.start()
+    future = concurrent.futures.Future()
+    _hash_queue.put((future, path))
+    return future
+
+
+def cancel_background_hashing():
+    """Cancel all files queued for hashing that hasn't been started."""
+    while True:
+        try:
+            future, path = _hash_queue.get_nowait()
+        except queue.Empty:
+            return
+        future.cancel()
+
+
+def _hash_files():
+    while True:
+        future, path = _hash_queue.get()
+        if not future.set_running_or_notify_cancel():
+            continue
+        try:
+            future.set_result(get_file_hash(path))
+        except Exception as e:
+            future.set_exception(e)
 
 
 def get_file_stats(path, nfs_obj=None):
@@ -86,6 +86,15 @@ file_map_f_converters = {
     'mylist_other': lambda x: x or None
 }
 
+# file state bit -> file version, the first set bit (in this order) wins.
+# No bit set means version 1.
+file_state_version_map = {
+    0x04: 2,
+    0x08: 3,
+    0x10: 4,
+    0x20: 5
+}
+
 episode_type_map = {
     '1': 'regular',
     '2': 'special',
@@ -225,6 +234,12 @@ def _getCodes(attrmap, bitChain):
     return codeList
 
 
+# the masks sent with every ANIME and FILE request never change
+anime_bits_a = getAnimeBitsA(anime_map_a)
+file_bits_f = getFileBitsF(file_map_f)
+file_bits_a_epno = getFileBitsA(['epno'])
+
+
 def checkMapping(verbos=False):
     print("------")
     print("File F: " + str(checkMapFileF(verbos)))
@@ -0,0 +1,80 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload
+
+import adbb.db
+from adbb.db import AnimeTable, EpisodeTable, FileTable
+
+
+class FileMergeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.sessionmaker = adbb.db.init_db(
+            'sqlite:///' + os.path.join(self.tmpdir, 'adbb.db'))
+        now = datetime.datetime.now()
+        sess = self.sessionmaker()
+        sess.add(AnimeTable(
+            aid=1, year='2000', type='TV', nr_of_episodes=1,
+            highest_episode_number=1, special_ep_count=0, rating=5.0,
+            vote_count=0, temp_vote_count=0, review_count=0,
+            is_18_restricted=False, anidb_updated=now, special_count=0,
+            credit_count=0, other_count=0, trailer_count=0, parody_count=0,
+            updated=now))
+        sess.add(EpisodeTable(
+            aid=1, eid=10, epno='1', length=24, votes=0,
+            title_eng='Episode 1', type='regular', updated=now))
+        sess.add(FileTable(
+            aid=1, eid=10, fid=100, is_generic=False, updated=now))
+        sess.commit()
+        sess.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_merge_file_leaves_anime_alone(self):
+        # load the file together with its anime, like adbb.animeobjs does
+        sess = self.sessionmaker()
+        stale = sess.execute(
+            select(FileTable)
+            .options(joinedload(FileTable.anime), joinedload(FileTable.episode))
+            .where(FileTable.fid == 100)).scalars().first()
+        sess.close()
+        self.assertEqual(stale.anime.rating, 5.0)
+
+        # the anime and episode are updated from somewhere else...
+        sess = self.sessionmaker()
+        anime = sess.execute(
+            select(AnimeTable).where(AnimeTable.aid == 1)).scalars().first()
+        anime.rating = 8.0
+        episode = sess.execute(
+            select(EpisodeTable).where(EpisodeTable.eid == 10)).scalars().first()
+        episode.title_eng = 'Updated'
+        sess.commit()
+        sess.close()
+
+        # ...and then the file is saved
+        stale.size = 1234
+        sess = self.sessionmaker()
+        sess.merge(stale)
+        sess.commit()
+        sess.close()
+
+        sess = self.sessionmaker()
+        self.assertEqual(sess.execute(
+            select(FileTable.size).where(FileTable.fid == 100)).scalar(), 1234)
+        self.assertEqual(sess.execute(
+            select(AnimeTable.rating).where(AnimeTable.aid == 1)).scalar(), 8.0)
+        self.assertEqual(sess.execute(
+            select(EpisodeTable.title_eng).where(EpisodeTable.eid == 10)).scalar(),
+            'Updated')
+        sess.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+
+from adbb.fileinfo import ep_nr_re, search_ep_nr
+
+
+def _search_ep_nr_sequential(filename):
+    for r in ep_nr_re:
+        if r is None:
+            return None
+        res = r.search(filename)
+        if res:
+            return res
+    return None
+
+
+class SearchEpNrTest(unittest.TestCase):
+
+    filenames = [
+        'Show.S01E02.720p.mkv',
+        'Show.s01.e05.mkv',
+        'Show S01 - E12 [group].mkv',
+        'Show.ep_01.mkv',
+        'Show EP07 (BD).mkv',
+        'Show.1x09.mkv',
+        '/anime/Show/1x10 - title.mkv',
+        'Show - 03.mkv',
+        '[Group] Show - 03 [720p].mkv',
+        'Show - 03-04.mkv',
+        'Show_-_124.mkv',
+        'Show - Special 2.mkv',
+        'Show.sp.01.mkv',
+        'Show - S3.mkv',
+        'Show.Specials.mkv',
+        'Show - NCOP.mkv',
+        'Show 2nd season - 05.mkv',
+        # higher priority patterns matching later in the filename
+        'Show - 12 - S02E03.mkv',
+        'Show - 100 - ep_04.mkv',
+        'Show - 5 - 2x07.mkv',
+        'Show - 20 - sp 3.mkv',
+        'Show - 7 - S01E01 - ep02 - 1x03.mkv',
+        'Show.mkv',
+        'episode01',
+        '',
+    ]
+
+    def test_same_as_sequential_search(self):
+        for filename in self.filenames:
+            with self.subTest(filename=filename):
+                expected = _search_ep_nr_sequential(filename)
+                res = search_ep_nr(filename)
+                if expected is None:
+                    self.assertIsNone(res)
+                else:
+                    self.assertIsNotNone(res)
+                    self.assertIs(res.re, expected.re)
+                    self.assertEqual(res.span(), expected.span())
+                    self.assertEqual(res.groups(), expected.groups())
+
+    def test_higher_priority_pattern_later_in_filename(self):
+        res = search_ep_nr('Show - 12 - S02E03.mkv')
+        self.assertIs(res.re, ep_nr_re[0])
+        self.assertEqual(res.group(2), '03')
+
+
+if __name__ == '__main__':
+    unittest.main()